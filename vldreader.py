@@ -9,18 +9,18 @@ except ImportError:
     from urllib import urlencode
 import urllib3
 import json
+import struct
 import time
 import socket
+import selectors
+import sys
 import argparse
 from datetime import datetime, timezone
 import os
 import logging
-import queue
+import collections
 import threading
 from tqdm import tqdm
-from scapy.all import Ether, IP, UDP
-from scapy.utils import PcapWriter
-from prettytable import PrettyTable
 
 # velodyne
 # https://github.com/valgur/velodyne_decoder
@@ -35,6 +35,51 @@ supportModels = list(vd.Model.__entries)
 print(f"Support models: {supportModels}")
 from velodyne_decoder_pylib import *
 
+# pcap global header: magic, version 2.4, thiszone, sigfigs, snaplen 65535, linktype 1 (Ethernet)
+PCAP_GLOBAL_HEADER = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+# dst mac addr is broadcast with no doubt, but the src mac addr is also broadcast from the pcap file recorded by veloview. This would not affect the function of captured pcap file.
+ETHER_HEADER = b'\xff' * 12 + b'\x08\x00'
+# src ip should be the ip of the lidar but is 192.168.0.200 in the pcap file recorded by veloview. This would not affect the function of captured pcap file.
+IP_SRC = socket.inet_aton('192.168.0.200')
+IP_DST = socket.inet_aton('255.255.255.255')
+# SO_TIMESTAMPNS is not exported by the socket module, 35 is its value in asm-generic (x86, arm, ...)
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+# with that option the kernel sends a native `struct timespec {long tv_sec; long tv_nsec;}`, 8 bytes on 32-bit systems
+TIMESPEC = struct.Struct('@ll')
+
+
+def ipChecksum(header: bytes) -> int:
+    """
+    Internet checksum (RFC 1071) of a 20-byte IPv4 header.
+    """
+    total = sum(struct.unpack('!10H', header))
+    total = (total & 0xffff) + (total >> 16)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def kernelTimestamp(ancdata: list) -> int:
+    """
+    Receive time (ns since epoch) of a datagram from the `SO_TIMESTAMPNS` control message returned by `recvmsg`, falling back to `time.time_ns()`.
+    """
+    for level, ctype, data in ancdata:
+        if level == socket.SOL_SOCKET and ctype == SO_TIMESTAMPNS:
+            sec, nsec = TIMESPEC.unpack_from(data)
+            return sec * 1_000_000_000 + nsec
+    return time.time_ns()
+
+
+def etherIPUDPHeader(sport: int, dport: int, payloadLen: int) -> bytes:
+    """
+    Build the 42-byte Ether/IPv4/UDP header that prefixes a lidar packet in the pcap file.
+    """
+    udpLen = 8 + payloadLen
+    # version/ihl, tos, total length, id, flags/fragment, ttl, protocol (UDP), checksum, src, dst
+    ipHeader = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + udpLen, 1, 0, 64, 17, 0, IP_SRC, IP_DST)
+    ipHeader = ipHeader[:10] + struct.pack('!H', ipChecksum(ipHeader)) + ipHeader[12:]
+    # checksum is set to 0 (ignore) according to the pcap file recorded by veloview.
+    return ETHER_HEADER + ipHeader + struct.pack('!HHHH', sport, dport, udpLen, 0)
+
 
 class ld:
     """
@@ -55,6 +100,10 @@ class ld:
             To return arrays of structs instead of the default contiguous arrays, set `as_pcl_structs=True`.
         filePref: string
             Filename prefix of the output `.pcap` and `.log` files. Default: `<model>_<rpm><returnMode>_<UTCtimestamp>`.
+        rcvbuf: int
+            Requested kernel receive buffer size (bytes) of the UDP socket. Linux caps it at `net.core.rmem_max`. Default: 16 MiB.
+        maxQueued: int
+            Maximum number of received packets waiting to be written to the pcap file. Packets beyond it are dropped and counted. Default: 65536.
     """
 
     def __init__(self, model: str = '',
@@ -66,7 +115,9 @@ class ld:
                  as_pcl_structs: bool = False,
                  outputRoot: str = '',
                  filePref: str = None,
-                 logger: logging.Logger = None) -> None:
+                 logger: logging.Logger = None,
+                 rcvbuf: int = 16 * 1024 * 1024,
+                 maxQueued: int = 65536) -> None:
         assert model in supportModels, f"Unsupported model {model}, please choose from {supportModels}."
         # utils
         self.progressBar = None
@@ -101,11 +152,35 @@ class ld:
         self.Base_URL = 'http://'+self.lidarip+'/cgi/'
         self.logger.info(f"Base_URL:{self.Base_URL}")
         self.buffer = BytesIO()
+        self.http = urllib3.PoolManager(maxsize=1)  # shared by status queries to reuse the connection
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.bind((self.localhost, self.dataPort))
-
-        # data container
-        self.qStream = queue.Queue()
+        # enlarge the kernel receive buffer so bursts survive writer stalls. The kernel caps it at net.core.rmem_max.
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        grantedRcvbuf = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if sys.platform.startswith('linux'):
+            grantedRcvbuf //= 2  # Linux doubles the value for its bookkeeping overhead and reports the doubled size
+        self.logger.info(f"UDP receive buffer: {grantedRcvbuf} bytes.")
+        if grantedRcvbuf < rcvbuf:
+            self.logger.warning(
+                f"Requested a {rcvbuf}-byte receive buffer but got {grantedRcvbuf}, raise it with `sysctl -w net.core.rmem_max={rcvbuf}`.")
+        # let the kernel timestamp each datagram on arrival instead of calling time.time() after every recv
+        self.kernelStamp = sys.platform.startswith('linux')
+        if self.kernelStamp:
+            try:
+                self.socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            except OSError as e:
+                self.logger.warning(f"Cannot enable SO_TIMESTAMPNS, packets are stamped on receipt in userspace instead: {e}")
+                self.kernelStamp = False
+        self.recvSize = vd.PACKET_SIZE * 2
+
+        # data container, deque append/popleft are thread-safe without taking a lock
+        self.qStream = collections.deque()
+        self.dataReady = threading.Event()  # set by _recvfrom when qStream gets new data
+        # reusable receive buffers, handed back by stream2pcap() once a packet is written.
+        # The pool grows up to `maxQueued` buffers, which bounds the memory held by packets waiting to be written.
+        self.bufPool = [bytearray(self.recvSize) for _ in range(min(256, maxQueued))]
+        self.maxQueued = maxQueued
 
         # workflow flag
         self.stream2pcapFlag = False  # use this flag to break loop in func stream2pcap()
@@ -139,6 +214,9 @@ class ld:
         """
         From VLP-16 user mannual
         """
+        # the response body is not used, drop the previous one instead of appending to it
+        buf.seek(0)
+        buf.truncate()
         self.sensor.setopt(self.sensor.URL, url)
         self.sensor.setopt(self.sensor.POSTFIELDS, pf)
         self.sensor.setopt(self.sensor.WRITEDATA, buf)
@@ -164,34 +242,61 @@ class ld:
         """
         Summarize lidar settings.
         """
-        tb = PrettyTable(field_names=["key", "value"])
-        tb.add_rows(
-            [
-                ["model", f"{self.model}"],
-                ["lidar's address", f"{self.lidarip}"],
-                ["data port", f"{self.dataPort}"],
-                ["rpm", f"{self.rpm}"],
-                ["returnMode", f"{self.returnMode}"],
-            ]
-        )
+        rows = [
+            ["key", "value"],
+            ["model", f"{self.model}"],
+            ["lidar's address", f"{self.lidarip}"],
+            ["data port", f"{self.dataPort}"],
+            ["rpm", f"{self.rpm}"],
+            ["returnMode", f"{self.returnMode}"],
+        ]
+        keyWidth = max(len(key) for key, _ in rows)
+        valueWidth = max(len(value) for _, value in rows)
+        border = f"+-{'-' * keyWidth}-+-{'-' * valueWidth}-+"
+        lines = [f"| {key:^{keyWidth}} | {value:^{valueWidth}} |" for key, value in rows]
+        tb = '\n'.join([border, lines[0], border, *lines[1:], border])
         self.logger.info(
             f"Initialize lidar device with the following settings\n{tb}")
 
+    def getStatus(self):
+        """
+        Return the parsed `status.json` of the lidar, or None if it did not answer. Reuses the connection kept by `self.http`.
+        """
+        response = self.http.request('GET', self.Base_URL+"status.json")
+        if response:
+            return json.loads(response.data)
+
     def isAlive(self):
         """
         Return True if `laser is On` or `rpm!=0`.
         """
-        http = urllib3.PoolManager()
-        response = http.request('GET', self.Base_URL+"status.json")
-        if response:
-            status = json.loads(response.data)
+        status = self.getStatus()
+        if status:
             if status['laser']['state'] == 'On' or status['motor']['rpm'] != 0:
                 return True
             else:
                 return False
 
+    def runPinned(self, target, args: tuple = (), cpu: int = None, priority: int = 0):
+        """
+        Run `target(*args)` in the calling thread after pinning it to `cpu` and, if `priority`>0, switching it to `SCHED_FIFO`.
+        Both are Linux only; `SCHED_FIFO` needs root or CAP_SYS_NICE. Failures are logged and the target still runs.
+        """
+        if cpu is not None:
+            try:
+                os.sched_setaffinity(0, {cpu})
+            except (AttributeError, OSError, ValueError) as e:
+                self.logger.warning(f"Cannot pin thread {threading.current_thread().name} to CPU {cpu}: {e}")
+        if priority > 0:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+            except (AttributeError, OSError, ValueError) as e:
+                self.logger.warning(f"Cannot set SCHED_FIFO for thread {threading.current_thread().name}: {e}")
+        return target(*args)
+
     def initProgressBar(self, maxiters: int, desc: str = None):
-        return tqdm(total=maxiters, desc=desc)
+        # redraw at most twice a second, the bar is updated once per written packet
+        return tqdm(total=maxiters, desc=desc, mininterval=0.5, miniters=100)
 
     def launch(self):
         self.logger.info(f"Launch the device {self.model} at {self.lidarip}:")
@@ -210,10 +315,8 @@ class ld:
             rc = self.sensor_do(self.Base_URL+'setting',
                                 urlencode({'laser': 'on'}), self.buffer)
 
-        http = urllib3.PoolManager()
-        response = http.request('GET', self.Base_URL+"status.json")
-        if response:
-            status = json.loads(response.data)
+        status = self.getStatus()
+        if status:
             self.logger.info(
                 f"Sensor laser is {status['laser']['state']}, motor rpm is {status['motor']['rpm']}")
 
@@ -228,31 +331,92 @@ class ld:
                                 urlencode({'laser': 'off'}), self.buffer)
         if rc:
             time.sleep(10)
-            http = urllib3.PoolManager()
-            response = http.request('GET', self.Base_URL+"status.json")
-            if response:
-                status = json.loads(response.data)
+            status = self.getStatus()
+            if status:
                 self.logger.info(
                     f"Sensor laser is {status['laser']['state']}, motor rpm is {status['motor']['rpm']}")
         self.socket.close()
         self.sensor.close()
+        self.http.clear()
 
     def read_live_data(self):
         """
         https://github.com/valgur/velodyne_decoder/issues/4#issuecomment-1248660033
         """
-        while True:
-            data, address = self.socket.recvfrom(vd.PACKET_SIZE * 2)
-            recv_stamp = time.time()
-            yield self.decoder.decode(recv_stamp, data, self.as_pcl_structs)
-
-    def _recvfrom(self):
-        while not self.stream2pcapFlag:
-            # push tuple (timeStamp, data, addr) to the queue
-            self.qStream.put(
-                item=(time.time(), *self.socket.recvfrom(vd.PACKET_SIZE * 2)))
-        self.progressBar = self.initProgressBar(
-            maxiters=self.qStream.qsize(), desc="Writing pcaps")
+        # bind per-packet lookups once, outside the receive loop
+        recvSize = self.recvSize
+        decode, as_pcl_structs = self.decoder.decode, self.as_pcl_structs
+        if self.kernelStamp:  # take the receive time from the kernel, see _recvfrom()
+            recvmsg, ancSize = self.socket.recvmsg, socket.CMSG_SPACE(TIMESPEC.size)
+            while True:
+                data, ancdata, _, address = recvmsg(recvSize, ancSize)
+                yield decode(kernelTimestamp(ancdata) * 1e-9, data, as_pcl_structs)
+        else:
+            recvfrom = self.socket.recvfrom
+            while True:
+                data, address = recvfrom(recvSize)
+                recv_stamp = time.time()
+                yield decode(recv_stamp, data, as_pcl_structs)
+
+    def _recvfrom(self, batchSize: int = 32):
+        recvSize = self.recvSize
+        append, bufPool, dataReady = self.qStream.append, self.bufPool, self.dataReady
+        if self.kernelStamp:  # recvmsg_into/CMSG_SPACE are not available on every platform
+            recvmsg_into, ancSize = self.socket.recvmsg_into, socket.CMSG_SPACE(TIMESPEC.size)
+
+            def recv(buf, flags):
+                nbytes, ancdata, _, address = recvmsg_into((buf,), ancSize, flags)
+                return kernelTimestamp(ancdata), memoryview(buf)[:nbytes], address
+        else:
+            recvfrom_into = self.socket.recvfrom_into
+
+            def recv(buf, flags):
+                nbytes, address = recvfrom_into(buf, 0, flags)
+                return time.time_ns(), memoryview(buf)[:nbytes], address
+        dontWait = getattr(socket, 'MSG_DONTWAIT', None)
+        nBuffers, maxQueued, dropped = len(bufPool), self.maxQueued, 0
+        scratch = bytearray(recvSize)  # receives packets that are dropped because the queue is full
+
+        def newBuffer():
+            nonlocal nBuffers
+            if nBuffers >= maxQueued:
+                return scratch
+            nBuffers += 1
+            return bytearray(recvSize)
+        # wait for readability with a timeout, so `stream2pcapFlag` is honoured even when the lidar sends nothing
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.socket, selectors.EVENT_READ)
+            while not self.stream2pcapFlag:
+                if not selector.select(timeout=0.1):
+                    continue
+                # read the first packet, then drain what the kernel already queued (at most `batchSize` reads, dropped ones included)
+                batch, flags = [], 0
+                for _ in range(batchSize):
+                    # grow the pool only when the writer falls behind
+                    buf = bufPool.pop() if bufPool else newBuffer()
+                    try:
+                        packet = recv(buf, flags)
+                    except BlockingIOError:
+                        if buf is not scratch:
+                            bufPool.append(buf)
+                        break
+                    if buf is scratch:
+                        dropped += 1
+                    else:
+                        batch.append(packet)
+                    if dontWait is None:
+                        break
+                    flags = dontWait
+                if batch:
+                    # push list of tuples (timeStamp in ns, data, addr) to the queue
+                    append(batch)
+                    if not dataReady.is_set():
+                        dataReady.set()
+        if dropped:
+            self.logger.warning(
+                f"Dropped {dropped} packets because {maxQueued} packets were already waiting to be written.")
+        append(None)  # sentinel: no more packets for stream2pcap()
+        dataReady.set()
         self.stop()
 
     def stream2pcap(self, baseThread: threading.Thread = None, filename: str = None):
@@ -263,49 +427,77 @@ class ld:
             if not os.path.exists(outdir):
                 os.makedirs(outdir)
             filename = os.path.join(outdir, self.filePref+'.pcap')
-        etherIPHead = (
-            # dst mac addr is broadcast with no doubt, but the src mac addr is also broadcast from the pcap file recorded by veloview. This would not affect the function of captured pcap file.
-            Ether(src='ff:ff:ff:ff:ff:ff', dst='ff:ff:ff:ff:ff:ff')
-            # src ip should be the ip of the lidar but is 192.168.0.200 in the pcap file recorded by veloview. This would not affect the function of captured pcap file.
-            / IP(src='192.168.0.200', dst='255.255.255.255')
-        )
-        # Make sure setting `sync=True` for steady file output. Otherwise the frames parsed by veloview would be chaotic.
-        pktWriter = PcapWriter(filename=filename, sync=True)
+        # Records are buffered in userspace and written 64 KiB at a time. The buffer is flushed once the queue has been empty for 0.1 s.
+        pktWriter = open(filename, 'wb', buffering=64 * 1024)
+        pktWriter.write(PCAP_GLOBAL_HEADER)
+        # The file is written once front to back and never read back. Hint sequential access, and regularly ask the
+        # kernel to drop its cached pages (POSIX only) so a long capture does not evict the rest of the page cache.
+        fadvise = getattr(os, 'posix_fadvise', None)
+        if fadvise is not None:
+            fadvise(pktWriter.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        releaseAt = 8192  # packet count of the next page cache release
+        # Ether/IP/UDP headers built so far, keyed by (port, payload length). Velodyne packets of one capture share both.
+        headers = {}
         counter = 0
+        # open-ended until receiving stops, updated per packet instead of logging each one
+        self.progressBar = self.initProgressBar(maxiters=None, desc="Writing pcaps")
+        update = self.progressBar.update
+        popleft, dataReady, write = self.qStream.popleft, self.dataReady, pktWriter.write
         while True:
-            if self.qStream.empty() and not baseThread.is_alive():  # exit thread
-                break
-            elif self.qStream.empty() and baseThread.is_alive():  # waiting for data
-                # print(f"q is empty, continue.")
+            # once _recvfrom queued its sentinel, only this thread changes qStream, so the total is exact
+            if self.progressBar.total is None and self.qStream and self.qStream[-1] is None:
+                remaining = sum(len(batch) for batch in self.qStream.copy() if batch)
+                # the first sample is discarded, clamp for a capture that received nothing at all
+                self.progressBar.total = max(0, self.progressBar.n + remaining - (counter == 0))
+                self.progressBar.refresh()
+            try:
+                item = popleft()
+            except IndexError:  # waiting for data
+                if not baseThread.is_alive():  # exit thread
+                    break
+                if not dataReady.wait(timeout=0.1):
+                    pktWriter.flush()
+                    if fadvise is not None:
+                        fadvise(pktWriter.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                dataReady.clear()
                 continue
-            else:  # processing data
-                oneTimestamp, oneData, oneAddress = self.qStream.get()
+            if item is None:  # sentinel pushed by _recvfrom on exit
+                break
+            for oneTimestamp, oneData, oneAddress in item:
                 # discard first (idx==0) sample due to its strange time difference to the 2nd sample
                 if counter == 0:
                     counter += 1
+                    self.bufPool.append(oneData.obj)
                     continue
                 counter += 1
-                packet = (
-                    etherIPHead
-                    # checksum is set to 0 (ignore) according to the pcap file recorded by veloview.
-                    / UDP(sport=oneAddress[1], dport=oneAddress[1], chksum=0)
-                    / oneData  # use operator / to append the recieved data at last
-                )
-                packet.time = oneTimestamp
-                if self.progressBar is not None:
-                    self.progressBar.update(1)
-                else:
-                    self.logger.info(
-                        f"Write pcap of timestamp {oneTimestamp} to file, {self.qStream.qsize()} samples wait to be written.")
-                pktWriter.write(packet)
+                payloadLen = len(oneData)
+                header = headers.get((oneAddress[1], payloadLen))
+                if header is None:
+                    header = headers[(oneAddress[1], payloadLen)] = etherIPUDPHeader(
+                        oneAddress[1], oneAddress[1], payloadLen)
+                capLen = 42 + payloadLen
+                sec, nsec = divmod(oneTimestamp, 1_000_000_000)
+                update(1)
+                # pcap record header (ts_sec, ts_usec, incl_len, orig_len), then the raw frame.
+                # The parts are copied into the file buffer one by one instead of being concatenated first.
+                write(struct.pack('<IIII', sec, nsec // 1000, capLen, capLen))
+                write(header)
+                write(oneData)
+                self.bufPool.append(oneData.obj)  # recycle the receive buffer once its bytes are copied
+            if fadvise is not None and counter >= releaseAt:
+                fadvise(pktWriter.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                releaseAt = counter + 8192
+        pktWriter.flush()
+        os.fsync(pktWriter.fileno())
+        if fadvise is not None:
+            fadvise(pktWriter.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
         pktWriter.close()
-        if self.progressBar is not None:
-            self.progressBar.close()
+        self.progressBar.close()
 
 
 def main(args):
     myld = ld(args.model, args.ip_lidar, args.dataport,
-              args.rpm, args.returnmode, outputRoot=args.outdir)
+              args.rpm, args.returnmode, outputRoot=args.outdir, rcvbuf=args.rcvbuf)
     utcDate = datetime.now(timezone.utc).strftime('%Y%m%d')
     utcHMS = datetime.now(timezone.utc).strftime('%H%M%S')
     outdir = os.path.join(args.outdir, utcDate, utcHMS, "lidarpcap")
@@ -332,11 +524,12 @@ def main(args):
             '_'+utc_time.strftime('%Y%m%dT%H%M%S.%f')
 
         threadList = []
-        threadRecv = threading.Thread(target=myld._recvfrom, name='_recvfrom')
+        threadRecv = threading.Thread(target=myld.runPinned, name='_recvfrom',
+                                      args=(myld._recvfrom, (), args.recv_cpu, args.recv_priority))
         threadList.append(threadRecv)
         pcapFilename = os.path.join(outdir, filenamePrefix+'.pcap')
         threadStream2pcap = threading.Thread(
-            target=myld.stream2pcap, name='stream2pcap', args=(threadRecv, pcapFilename))
+            target=myld.runPinned, name='stream2pcap', args=(myld.stream2pcap, (threadRecv, pcapFilename), args.writer_cpu))
         threadList.append(threadStream2pcap)
         for oneThread in threadList:
             myld.logger.info(f"Starting thread:\t{oneThread.name}.")
@@ -368,12 +561,20 @@ if __name__ == "__main__":
                         help="IP addr of localhost, not the velodyne lidar. Default:''(listen to all).")
     parser.add_argument('--dataport', default=2368, type=int, metavar="PORT",
                         help="Data port to be listened for UDP packages. Default: 2368.")
+    parser.add_argument('--rcvbuf', default=16 * 1024 * 1024, type=int, metavar="BYTES",
+                        help="Kernel receive buffer size of the UDP socket. Default: 16777216.")
     parser.add_argument('--rpm', default=1200, type=int,
                         metavar="RPM", help="RPM of the velodyne lidar to be set.")
     parser.add_argument('--returnmode', default='dual', choices=['strongest', 'last', 'dual'], type=str,
                         metavar="ReturnMode", help="pcap: read data and write to pcap file; live: read data in stream mode.")
     parser.add_argument('--mode', default='pcap', choices=['pcap', 'live'], type=str, metavar="MODE",
                         help="pcap: read data and write to pcap file; live: read data in stream mode.")
+    parser.add_argument('--recv-cpu', default=None, type=int, metavar="CPU",
+                        help="Pin the receiving thread to this CPU, ideally the one handling the NIC's IRQ (Linux only). Default: not pinned.")
+    parser.add_argument('--writer-cpu', default=None, type=int, metavar="CPU",
+                        help="Pin the pcap writing thread to this CPU, preferably another physical core than --recv-cpu (Linux only). Default: not pinned.")
+    parser.add_argument('--recv-priority', default=0, type=int, metavar="PRIO",
+                        help="Run the receiving thread with SCHED_FIFO at this priority (1-99, needs CAP_SYS_NICE). Default: 0 (normal scheduling).")
     parser.add_argument('--outdir', default='out', type=str,
                         metavar="DIR", help="output path.")
     args = parser.parse_args()